@@ -1,6 +1,15 @@
+import argparse
+import socket
 from PyQt5 import QtWidgets, QtCore, QtGui
 from view.main_window import MainWindow
-from model.devices import Enose, DataBuffer, DataManager
+from model.devices import Enose, DataBuffer, DataManager, \
+    BaselineDriftCompensator
+from model.acquisition import AcquisitionClient
+from model.streaming import LiveDataServer
+from model.replay import ReplayDevice
+from model.recording import VideoRecorder
+from model.eventlog import SessionEventLog
+from model.recognition import OdorClassifier, OdorRecognizer
 
 
 def initializeDeliverySystem():
@@ -26,60 +35,179 @@ def desorptionCallback():
     ui.logDesorptionStartPoint()
 
 
-app = QtWidgets.QApplication([])
-ui = MainWindow()
-enose = Enose()
-dataBuffer = DataBuffer()
-dataManager = DataManager()
-
-ui.serial_requested.connect(enose.searchSerial)
-ui.serial_opened.connect(enose.openSerial)
-ui.serial_closed.connect(enose.closeSerial)
-ui.serial_started.connect(enose.runSerial)
-ui.serial_stopped.connect(enose.stopSerial)
-ui.video_opened.connect(enose.openMicroscope)
-ui.video_closed.connect(enose.closeMicroscope)
-ui.video_started.connect(enose.runMicroscope)
-ui.video_stopped.connect(enose.stopMicroscope)
-
-ui.sampling_started.connect(dataBuffer.startRecording)
-ui.sampling_stopped.connect(dataBuffer.stopRecording)
-ui.delivery_started.connect(initializeDeliverySystem)
-ui.delivery_stopped.connect(stopDeliverySystem)
-
-ui.upped.connect(dataBuffer.moveRectangleUp)
-ui.downed.connect(dataBuffer.moveRectangleDown)
-ui.lefted.connect(dataBuffer.moveRectangleLeft)
-ui.righted.connect(dataBuffer.moveRectangleRight)
-ui.width_increased.connect(dataBuffer.increaseRectangleWidth)
-ui.width_decreased.connect(dataBuffer.decreaseRectangleWidth)
-ui.height_increased.connect(dataBuffer.increaseRectangleHeight)
-ui.height_decreased.connect(dataBuffer.decreaseRectangleHeight)
-
-enose.serialSignals.port_found.connect(ui.setPorts)
-enose.serialSignals.connected.connect(ui.logConnectedSerialDevice)
-enose.serialSignals.disconnected.connect(ui.logDisconnectedSerialDevice)
-enose.serialSignals.sampled.connect(dataBuffer.receiveSerialData)
-
-enose.microscopeSignals.connected.connect(ui.logConnectedMicroscope)
-enose.microscopeSignals.disconnected.connect(ui.logDisconnectedMicroscope)
-enose.microscopeSignals.sampled.connect(dataBuffer.receiveImageData)
-
-dataBuffer.signals.serial_data_ready.connect(ui.showData)
-dataBuffer.signals.microscope_data_ready.connect(ui.showImage)
-dataBuffer.signals.sample_timer_timeout.connect(ui.setTimerValue)
-dataBuffer.signals.sampling_completed.connect(dataManager.saveData)
-dataBuffer.signals.sampling_completed.connect(ui.logCompleteSampling)
-dataBuffer.signals.image_captured.connect(ui.logImageCaptured)
-dataBuffer.signals.baseline_started.connect(baslineCallback)
-dataBuffer.signals.adsorption_started.connect(adsorptionCallback)
-dataBuffer.signals.desorption_started.connect(desorptionCallback)
-
-ui.show()
-app.exec_()
-dataBuffer.stopRecording()
-enose.writeSerial("0\n")
-enose.stopSerial()
-enose.closeSerial()
-enose.stopMicroscope()
-enose.closeMicroscope()
+def confidentCallback(label):
+    if ui.isEarlyStopEnabled():
+        dataBuffer.endAdsorption()
+        ui.logEarlyAdsorptionEnd(label)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--acquisition-process", action="store_true",
+                        help="acquire data in a separate process")
+    parser.add_argument("--replay", metavar="DATASET_PATH",
+                        help="replay recorded samples instead of devices")
+    parser.add_argument("--replay-speed", type=float, default=1.0,
+                        help="multiple of real time, 0 replays at full speed")
+    parser.add_argument("--drift-compensation",
+                        choices=BaselineDriftCompensator.MODES,
+                        help="plot and store baseline corrected data")
+    parser.add_argument("--full-resolution-preview", action="store_true",
+                        help="show microscope frames without downscaling")
+    parser.add_argument("--channel-names",
+                        help="comma separated names of the sensor channels")
+    parser.add_argument("--record-video", choices=VideoRecorder.MODES,
+                        help="record the ROI or the full frame as video")
+    parser.add_argument("--video-fps", type=float, default=30,
+                        help="nominal frame rate of recorded videos")
+    parser.add_argument("--odor-model",
+                        help="recognize odors live with this trained model")
+    parser.add_argument("--odor-confidence", type=float, default=0.9,
+                        help="confidence needed to end adsorption early")
+    parser.add_argument("--stream-port", type=int,
+                        help="publish live data on this localhost port")
+    parser.add_argument("--stream-socket",
+                        help="publish live data on this unix socket")
+    parser.add_argument("--stream-frame-width", type=int, default=160,
+                        help="width of streamed frames, 0 disables them")
+    parser.add_argument("--stream-drop-policy", default="drop_oldest",
+                        choices=["drop_oldest", "drop_newest", "disconnect"],
+                        help="what to do when a subscriber falls behind")
+    args = parser.parse_args()
+
+    app = QtWidgets.QApplication([])
+    ui = MainWindow()
+    ui.isPreviewScaled = not args.full_resolution_preview
+    if args.replay:
+        enose = ReplayDevice(args.replay, args.replay_speed)
+    elif args.acquisition_process:
+        enose = AcquisitionClient()
+    else:
+        enose = Enose()
+    dataBuffer = DataBuffer()
+    dataManager = DataManager()
+    if args.replay:
+        dataBuffer.clock = enose.clock
+        if args.replay_speed:
+            dataBuffer.timeScale = args.replay_speed
+    eventLog = SessionEventLog(dataManager.datasetPath)
+    if args.channel_names:
+        dataBuffer.setChannelNames(
+            [name.strip() for name in args.channel_names.split(",")])
+        ui.setChannels(dataBuffer.channelNames)
+    if args.record_video:
+        dataBuffer.videoRecorder = VideoRecorder(dataManager.datasetPath,
+                                                 args.record_video,
+                                                 args.video_fps)
+        dataBuffer.videoRecorder.signals.failed.connect(ui.logError)
+    if args.drift_compensation:
+        dataBuffer.driftCompensator = BaselineDriftCompensator(
+            args.drift_compensation)
+        ui.enableCorrectedPlot(args.drift_compensation)
+
+    ui.serial_requested.connect(enose.searchSerial)
+    ui.serial_opened.connect(enose.openSerial)
+    ui.serial_closed.connect(enose.closeSerial)
+    ui.serial_started.connect(enose.runSerial)
+    ui.serial_stopped.connect(enose.stopSerial)
+    ui.video_opened.connect(enose.openMicroscope)
+    ui.video_closed.connect(enose.closeMicroscope)
+    ui.video_started.connect(enose.runMicroscope)
+    ui.video_stopped.connect(enose.stopMicroscope)
+
+    ui.sampling_started.connect(eventLog.start)
+    ui.sampling_started.connect(dataBuffer.startRecording)
+    ui.sampling_stopped.connect(dataBuffer.stopRecording)
+    ui.delivery_started.connect(initializeDeliverySystem)
+    ui.delivery_stopped.connect(stopDeliverySystem)
+
+    ui.upped.connect(dataBuffer.moveRectangleUp)
+    ui.downed.connect(dataBuffer.moveRectangleDown)
+    ui.lefted.connect(dataBuffer.moveRectangleLeft)
+    ui.righted.connect(dataBuffer.moveRectangleRight)
+    ui.width_increased.connect(dataBuffer.increaseRectangleWidth)
+    ui.width_decreased.connect(dataBuffer.decreaseRectangleWidth)
+    ui.height_increased.connect(dataBuffer.increaseRectangleHeight)
+    ui.height_decreased.connect(dataBuffer.decreaseRectangleHeight)
+
+    enose.serialSignals.port_found.connect(ui.setPorts)
+    enose.serialSignals.connected.connect(ui.logConnectedSerialDevice)
+    enose.serialSignals.disconnected.connect(ui.logDisconnectedSerialDevice)
+    enose.serialSignals.failed.connect(ui.logError)
+    enose.serialSignals.sampled.connect(dataBuffer.receiveSerialData)
+    enose.serialSignals.parsed.connect(dataBuffer.receiveSerialValues)
+    enose.serialSignals.channels_named.connect(dataBuffer.setChannelNames)
+
+    enose.microscopeSignals.connected.connect(ui.logConnectedMicroscope)
+    enose.microscopeSignals.disconnected.connect(ui.logDisconnectedMicroscope)
+    enose.microscopeSignals.failed.connect(ui.logError)
+    enose.microscopeSignals.sampled.connect(dataBuffer.receiveImageData)
+
+    dataBuffer.signals.serial_data_ready.connect(ui.showData)
+    dataBuffer.signals.channels_named.connect(ui.setChannels)
+    dataBuffer.signals.corrected_data_ready.connect(ui.showCorrectedData)
+    dataBuffer.signals.microscope_data_ready.connect(ui.showImage)
+    dataBuffer.signals.sample_timer_timeout.connect(ui.setTimerValue)
+    dataBuffer.signals.sampling_completed.connect(dataManager.saveData)
+    dataBuffer.signals.sampling_completed.connect(ui.logCompleteSampling)
+    dataBuffer.signals.sampling_completed.connect(eventLog.stop)
+    ui.event_logged.connect(eventLog.record)
+    dataBuffer.signals.image_captured.connect(ui.logImageCaptured)
+    dataBuffer.signals.baseline_started.connect(baslineCallback)
+    dataBuffer.signals.adsorption_started.connect(adsorptionCallback)
+    dataBuffer.signals.desorption_started.connect(desorptionCallback)
+
+    if args.odor_model:
+        recognizer = OdorRecognizer(OdorClassifier.load(args.odor_model),
+                                    args.odor_confidence)
+        ui.enableRecognition()
+        dataBuffer.signals.sample_received.connect(recognizer.receiveSample)
+        dataBuffer.signals.roi_color_measured.connect(
+            recognizer.receiveColor)
+        dataBuffer.signals.baseline_started.connect(recognizer.startBaseline)
+        dataBuffer.signals.adsorption_started.connect(
+            recognizer.startAdsorption)
+        dataBuffer.signals.desorption_started.connect(recognizer.stop)
+        # A sample stopped by hand never reaches desorption
+        dataBuffer.signals.sampling_completed.connect(recognizer.stop)
+        recognizer.signals.predicted.connect(ui.showPrediction)
+        recognizer.signals.confident.connect(confidentCallback)
+
+    liveDataServer = None
+    if args.stream_port or args.stream_socket:
+        if args.stream_socket:
+            liveDataServer = LiveDataServer(
+                args.stream_socket, socket.AF_UNIX,
+                drop_policy=args.stream_drop_policy,
+                frame_width=args.stream_frame_width)
+        else:
+            liveDataServer = LiveDataServer(
+                ("127.0.0.1", args.stream_port),
+                drop_policy=args.stream_drop_policy,
+                frame_width=args.stream_frame_width)
+        liveDataServer.start()
+        dataBuffer.signals.sample_received.connect(
+            liveDataServer.publishSample)
+        dataBuffer.signals.microscope_data_ready.connect(
+            liveDataServer.publishFrame)
+        dataBuffer.signals.baseline_started.connect(
+            lambda: liveDataServer.publishEvent("baseline"))
+        dataBuffer.signals.adsorption_started.connect(
+            lambda: liveDataServer.publishEvent("adsorption"))
+        dataBuffer.signals.desorption_started.connect(
+            lambda: liveDataServer.publishEvent("desorption"))
+        dataBuffer.signals.sampling_completed.connect(
+            lambda sample_info: liveDataServer.publishEvent("completed"))
+
+    ui.show()
+    app.exec_()
+    dataBuffer.stopRecording()
+    enose.writeSerial("0\n")
+    enose.stopSerial()
+    enose.closeSerial()
+    enose.stopMicroscope()
+    enose.closeMicroscope()
+    if isinstance(enose, AcquisitionClient):
+        enose.shutdown()
+    if liveDataServer:
+        liveDataServer.stop()
@@ -0,0 +1,427 @@
+import multiprocessing
+import queue
+import threading
+import time
+from multiprocessing import shared_memory
+import numpy as np
+import cv2
+import serial
+from serial.tools.list_ports import comports
+from PyQt5 import QtCore
+from model.devices import SerialDeviceSignals, MicroscopeSignals, \
+    DataManager
+
+
+# Spawn keeps the acquisition process free of the GUI's Qt state on every
+# platform, so main.py must guard its top-level code with __main__.
+context = multiprocessing.get_context("spawn")
+
+
+class SharedRingBuffer():
+
+    # Shared memory layout:
+    #   counter[1]            next sequence number to be written
+    #   sequences[capacity]   sequence held by each slot, -1 while writing
+    #   lengths[capacity]     number of valid elements in each slot
+    #   timestamps[capacity]  time.time() of each slot
+    #   slots[capacity, *shape]
+
+    def __init__(self, shape, dtype=np.float64, capacity=64, name=None):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.capacity = capacity
+        self.isOwner = name is None
+        header_size = 8 * (1 + 3 * capacity)
+        slot_size = int(np.prod(self.shape)) * self.dtype.itemsize
+        if self.isOwner:
+            self.memory = shared_memory.SharedMemory(
+                create=True, size=header_size + capacity * slot_size)
+        else:
+            self.memory = shared_memory.SharedMemory(name=name)
+        buffer = self.memory.buf
+        self.counter = np.ndarray((1,), dtype=np.int64, buffer=buffer)
+        self.sequences = np.ndarray((capacity,), dtype=np.int64,
+                                    buffer=buffer, offset=8)
+        self.lengths = np.ndarray((capacity,), dtype=np.int64,
+                                  buffer=buffer, offset=8 * (1 + capacity))
+        self.timestamps = np.ndarray((capacity,), dtype=np.float64,
+                                     buffer=buffer,
+                                     offset=8 * (1 + 2 * capacity))
+        self.slots = np.ndarray((capacity,) + self.shape, dtype=self.dtype,
+                                buffer=buffer, offset=header_size)
+        if self.isOwner:
+            self.counter[0] = 0
+            self.sequences[:] = -1
+
+    @classmethod
+    def attach(cls, descriptor):
+        return cls(descriptor["shape"],
+                   descriptor["dtype"],
+                   descriptor["capacity"],
+                   descriptor["name"])
+
+    def descriptor(self):
+        return {"name": self.memory.name,
+                "shape": self.shape,
+                "dtype": self.dtype.str,
+                "capacity": self.capacity}
+
+    def claim(self):
+        sequence = int(self.counter[0])
+        index = sequence % self.capacity
+        self.sequences[index] = -1
+        return sequence, self.slots[index]
+
+    def commit(self, sequence, length=None, timestamp=None):
+        index = sequence % self.capacity
+        if length is None:
+            length = self.slots[index].size
+        self.lengths[index] = length
+        self.timestamps[index] = time.time() if timestamp is None \
+            else timestamp
+        self.sequences[index] = sequence
+        self.counter[0] = sequence + 1
+
+    def write(self, data, timestamp=None):
+        data = np.asarray(data, dtype=self.dtype).reshape(-1)
+        sequence, slot = self.claim()
+        slot.reshape(-1)[:data.size] = data
+        self.commit(sequence, data.size, timestamp)
+        return sequence
+
+    def latestSequence(self):
+        return int(self.counter[0]) - 1
+
+    def read(self, sequence):
+        index = sequence % self.capacity
+        if self.sequences[index] != sequence:
+            return None
+        timestamp = float(self.timestamps[index])
+        length = int(self.lengths[index])
+        data = self.slots[index].reshape(-1)[:length].copy()
+        # The writer may have lapped us while copying
+        if self.sequences[index] != sequence:
+            return None
+        if length == self.slots[index].size:
+            data = data.reshape(self.shape)
+        return timestamp, data
+
+    def readSince(self, sequence):
+        end = int(self.counter[0])
+        start = max(sequence, end - self.capacity)
+        dropped = start - sequence
+        items = list()
+        for current in range(start, end):
+            item = self.read(current)
+            if item is None:
+                dropped += 1
+            else:
+                items.append(item)
+        return end, items, dropped
+
+    def close(self):
+        self.counter = None
+        self.sequences = None
+        self.lengths = None
+        self.timestamps = None
+        self.slots = None
+        self.memory.close()
+        if self.isOwner:
+            self.memory.unlink()
+
+
+class AcquisitionProcess(context.Process):
+
+    def __init__(self, commands, events, sample_descriptor, frame_capacity=8):
+        context.Process.__init__(self, daemon=True)
+        self.commands = commands
+        self.events = events
+        self.sampleDescriptor = sample_descriptor
+        self.frameCapacity = frame_capacity
+
+    def run(self):
+        self.sampleRing = SharedRingBuffer.attach(self.sampleDescriptor)
+        self.frameRing = None
+        self.serialDevice = serial.Serial()
+        self.serialThread = None
+        self.isSerialRunning = False
+        self.channelNames = list()
+        self.microscope = None
+        self.microscopeThread = None
+        self.isMicroscopeRunning = False
+        while True:
+            command = self.commands.get()
+            if command[0] == "quit":
+                break
+            try:
+                getattr(self, command[0])(*command[1:])
+            except Exception as error:
+                kind = "microscope_error" if "Microscope" in command[0] \
+                    else "serial_error"
+                self.events.put((kind, f"{command[0]} failed: {error}"))
+        self.closeSerial()
+        self.closeMicroscope()
+        self.sampleRing.close()
+
+    def searchSerial(self):
+        ports = [info.device for info in comports()]
+        self.events.put(("port_found", ports))
+
+    def openSerial(self, deviceSettings):
+        if not self.serialDevice.is_open:
+            self.serialDevice.port = deviceSettings["port"]
+            self.serialDevice.baudrate = deviceSettings["baudrate"]
+            self.serialDevice.timeout = 0.1
+            self.serialDevice.open()
+            self.events.put(("serial_connected",))
+
+    def closeSerial(self):
+        if self.serialDevice.is_open:
+            self.stopSerial()
+            self.serialDevice.close()
+            self.events.put(("serial_disconnected",))
+
+    def writeSerial(self, string_data):
+        if self.serialDevice.is_open:
+            self.serialDevice.write(string_data.encode('utf-8'))
+
+    def runSerial(self, sample_interval):
+        if self.serialDevice.is_open and not self.isSerialRunning:
+            self.isSerialRunning = True
+            self.serialThread = threading.Thread(
+                target=self.serialLoop, args=(sample_interval,), daemon=True)
+            self.serialThread.start()
+
+    def stopSerial(self):
+        self.isSerialRunning = False
+        if self.serialThread:
+            self.serialThread.join()
+            self.serialThread = None
+
+    def serialLoop(self, sample_interval):
+        latest = None
+        next_sample_time = time.monotonic() + sample_interval
+        while self.isSerialRunning:
+            try:
+                line = self.serialDevice.readline()
+            except Exception as error:
+                # The board was unplugged or the port failed, runSerial
+                # can start a new thread once the port is usable again
+                self.isSerialRunning = False
+                self.events.put(("serial_error",
+                                 f"Serial read failed: {error}"))
+                break
+            if line:
+                fields = line.decode(errors="replace").split(",")
+                try:
+                    latest = [float(data) for data in fields]
+                except ValueError:
+                    names = DataManager.parseChannelNames(
+                        fields, len(latest) if latest else 0)
+                    if names and names != self.channelNames:
+                        self.channelNames = names
+                        self.events.put(("channels_named", names))
+            now = time.monotonic()
+            if now >= next_sample_time:
+                if latest:
+                    if len(latest) > self.sampleRing.shape[0]:
+                        self.growSampleRing(len(latest))
+                    self.sampleRing.write(latest)
+                next_sample_time += sample_interval
+
+    def growSampleRing(self, channels):
+        # Boards wider than the ring get a new one, the client drains the
+        # old ring before it switches over
+        sampleRing = SharedRingBuffer((channels,), self.sampleRing.dtype,
+                                      self.sampleRing.capacity)
+        self.events.put(("samples_resized", sampleRing.descriptor()))
+        # Attached readers keep their own mapping, unlink is safe
+        self.sampleRing.close()
+        self.sampleRing = sampleRing
+
+    def openMicroscope(self, videoport):
+        if not self.microscope:
+            self.microscope = cv2.VideoCapture(videoport)
+            ret, frame = self.microscope.read()
+            if ret:
+                shape = frame.shape
+            else:
+                shape = (
+                    int(self.microscope.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                    int(self.microscope.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                    3)
+            self.frameRing = SharedRingBuffer(shape, np.uint8,
+                                              self.frameCapacity)
+            self.events.put(("microscope_connected",
+                             self.frameRing.descriptor()))
+
+    def closeMicroscope(self):
+        if self.microscope:
+            self.stopMicroscope()
+            self.microscope.release()
+            self.microscope = None
+            self.events.put(("microscope_disconnected",))
+            # Attached readers keep their own mapping, unlink is safe
+            self.frameRing.close()
+            self.frameRing = None
+
+    def runMicroscope(self):
+        if self.microscope and not self.isMicroscopeRunning:
+            self.isMicroscopeRunning = True
+            self.microscopeThread = threading.Thread(
+                target=self.microscopeLoop, daemon=True)
+            self.microscopeThread.start()
+
+    def stopMicroscope(self):
+        self.isMicroscopeRunning = False
+        if self.microscopeThread:
+            self.microscopeThread.join()
+            self.microscopeThread = None
+
+    def microscopeLoop(self):
+        rawFrame = np.zeros(self.frameRing.shape, dtype=np.uint8)
+        while self.isMicroscopeRunning:
+            try:
+                ret, frame = self.microscope.read(image=rawFrame)
+                if ret and frame.shape == self.frameRing.shape:
+                    sequence, slot = self.frameRing.claim()
+                    cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=slot)
+                    self.frameRing.commit(sequence)
+            except Exception as error:
+                self.isMicroscopeRunning = False
+                self.events.put(("microscope_error",
+                                 f"Microscope read failed: {error}"))
+                break
+
+
+class AcquisitionClient():
+
+    def __init__(self, channel_capacity=64, sample_capacity=4096,
+                 poll_interval=10):
+        self.serialSignals = SerialDeviceSignals()
+        self.microscopeSignals = MicroscopeSignals()
+        self.sampleRing = SharedRingBuffer((channel_capacity,),
+                                           np.float64,
+                                           sample_capacity)
+        self.nextSample = 0
+        self.droppedSamples = 0
+        self.frameRing = None
+        self.nextFrame = 0
+        self.commands = context.Queue()
+        self.events = context.Queue()
+        self.process = AcquisitionProcess(self.commands,
+                                          self.events,
+                                          self.sampleRing.descriptor())
+        self.process.start()
+        self.pollTimer = QtCore.QTimer()
+        self.pollTimer.timeout.connect(self.poll)
+        self.pollTimer.start(poll_interval)
+
+    def searchSerial(self):
+        self.commands.put(("searchSerial",))
+
+    def openSerial(self, deviceSettings):
+        self.commands.put(("openSerial", deviceSettings))
+
+    def closeSerial(self):
+        self.commands.put(("closeSerial",))
+
+    def writeSerial(self, string_data):
+        print("Data sent", string_data.encode('utf-8'))
+        self.commands.put(("writeSerial", string_data))
+
+    def runSerial(self, sample_interval):
+        self.commands.put(("runSerial", sample_interval))
+
+    def stopSerial(self):
+        self.commands.put(("stopSerial",))
+
+    def openMicroscope(self, videoport):
+        self.commands.put(("openMicroscope", videoport))
+
+    def closeMicroscope(self):
+        self.commands.put(("closeMicroscope",))
+
+    def runMicroscope(self):
+        self.commands.put(("runMicroscope",))
+
+    def stopMicroscope(self):
+        self.commands.put(("stopMicroscope",))
+
+    def poll(self):
+        self.processEvents()
+        self.readSamples()
+        if self.frameRing:
+            # Frames are latest-wins, only samples must never be lost
+            latest = self.frameRing.latestSequence()
+            if latest >= self.nextFrame:
+                self.nextFrame = latest + 1
+                item = self.frameRing.read(latest)
+                if item:
+                    self.microscopeSignals.sampled.emit(item[1])
+        if not self.process.is_alive():
+            self.pollTimer.stop()
+            self.serialSignals.failed.emit("Acquisition process stopped")
+            if self.frameRing:
+                self.frameRing.close()
+                self.frameRing = None
+            self.serialSignals.disconnected.emit()
+            self.microscopeSignals.disconnected.emit()
+
+    def readSamples(self):
+        self.nextSample, samples, dropped = self.sampleRing.readSince(
+            self.nextSample)
+        self.droppedSamples += dropped
+        for timestamp, sample in samples:
+            self.serialSignals.parsed.emit(sample.tolist(), timestamp)
+
+    def processEvents(self):
+        while True:
+            try:
+                event = self.events.get_nowait()
+            except queue.Empty:
+                break
+            if event[0] == "port_found":
+                self.serialSignals.port_found.emit(event[1])
+            elif event[0] == "serial_connected":
+                self.serialSignals.connected.emit()
+            elif event[0] == "serial_disconnected":
+                self.serialSignals.disconnected.emit()
+            elif event[0] == "serial_error":
+                self.serialSignals.failed.emit(event[1])
+            elif event[0] == "microscope_error":
+                self.microscopeSignals.failed.emit(event[1])
+            elif event[0] == "samples_resized":
+                try:
+                    sampleRing = SharedRingBuffer.attach(event[1])
+                except FileNotFoundError:
+                    # Already replaced again by the acquisition process
+                    continue
+                self.readSamples()
+                self.sampleRing.close()
+                self.sampleRing = sampleRing
+                self.nextSample = 0
+            elif event[0] == "channels_named":
+                self.serialSignals.channels_named.emit(event[1])
+            elif event[0] == "microscope_connected":
+                try:
+                    self.frameRing = SharedRingBuffer.attach(event[1])
+                except FileNotFoundError:
+                    # Already closed again by the acquisition process
+                    continue
+                self.nextFrame = 0
+                self.microscopeSignals.connected.emit()
+            elif event[0] == "microscope_disconnected":
+                if self.frameRing:
+                    self.frameRing.close()
+                    self.frameRing = None
+                self.microscopeSignals.disconnected.emit()
+
+    def shutdown(self):
+        self.pollTimer.stop()
+        self.commands.put(("quit",))
+        self.process.join(5)
+        if self.frameRing:
+            self.frameRing.close()
+            self.frameRing = None
+        self.sampleRing.close()
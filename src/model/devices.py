@@ -3,6 +3,9 @@ from serial.tools.list_ports import comports
 from PyQt5 import QtCore
 import time
 import os
+import json
+import queue
+import threading
 import numpy as np
 import pandas as pd
 import cv2
@@ -14,6 +17,9 @@ class SerialDeviceSignals(QtCore.QObject):
     disconnected = QtCore.pyqtSignal()
     port_found = QtCore.pyqtSignal(list)
     sampled = QtCore.pyqtSignal(bytes)
+    parsed = QtCore.pyqtSignal(list, float)
+    channels_named = QtCore.pyqtSignal(list)
+    failed = QtCore.pyqtSignal(str)
 
 
 class SerialReadTask(QtCore.QRunnable):
@@ -37,6 +43,7 @@ class MicroscopeSignals(QtCore.QObject):
     connected = QtCore.pyqtSignal()
     disconnected = QtCore.pyqtSignal()
     sampled = QtCore.pyqtSignal(np.ndarray)
+    failed = QtCore.pyqtSignal(str)
 
 
 class MicroscopeReadTask(QtCore.QRunnable):
@@ -55,6 +62,27 @@ class MicroscopeReadTask(QtCore.QRunnable):
         self.__isRunning = False
 
 
+class FrameBufferPool():
+
+    def __init__(self, shape, size=4):
+        self.shape = tuple(shape)
+        self.free = queue.Queue()
+        for i in range(size):
+            self.free.put(np.zeros(self.shape, dtype=np.uint8))
+
+    def acquire(self):
+        try:
+            return self.free.get_nowait()
+        except queue.Empty:
+            return None
+
+    def release(self, buffer):
+        # Buffers from a pool that was replaced after a resolution change
+        # are simply dropped
+        if buffer.shape == self.shape:
+            self.free.put(buffer)
+
+
 class Enose():
 
     def __init__(self):
@@ -73,7 +101,11 @@ class Enose():
         self.microscopeTimer = QtCore.QTimer()
         self.microscopeTimer.timeout.connect(self.sampleMicroscope)
         self.microscopeReadTask = None
-        self.imageBuffer = np.zeros((500, 500))
+        self.rawFrame = None
+        self.framePool = None
+        self.frameLock = threading.Lock()
+        self.readyFrame = None
+        self.displayedFrame = None
         self.isMicroscopeRunning = False
 
     def searchSerial(self):
@@ -127,6 +159,15 @@ class Enose():
     def openMicroscope(self, videoport):
         if not self.microscope:
             self.microscope = cv2.VideoCapture(videoport)
+            shape = (int(self.microscope.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                     int(self.microscope.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                     3)
+            if not shape[0] or not shape[1]:
+                shape = (480, 640, 3)
+            self.rawFrame = np.zeros(shape, dtype=np.uint8)
+            self.framePool = FrameBufferPool(shape)
+            self.readyFrame = None
+            self.displayedFrame = None
             self.microscopeSignals.connected.emit()
 
     def closeMicroscope(self):
@@ -137,13 +178,22 @@ class Enose():
 
     def readMicroscope(self):
         if self.microscope:
-            ret, frame = self.microscope.read()
+            ret, frame = self.microscope.read(image=self.rawFrame)
+            if ret and frame.shape != self.framePool.shape:
+                # The driver reported a different resolution than it delivers
+                self.rawFrame = frame
+                self.framePool = FrameBufferPool(frame.shape)
+            buffer = self.framePool.acquire()
+            if buffer is None:
+                return
             if ret:
-                self.imageBuffer = cv2.cvtColor(
-                    frame,
-                    cv2.COLOR_BGR2RGB)
+                cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=buffer)
             else:
-                self.imageBuffer = np.zeros((500, 500))
+                buffer.fill(0)
+            with self.frameLock:
+                previous, self.readyFrame = self.readyFrame, buffer
+            if previous is not None:
+                self.framePool.release(previous)
 
     def runMicroscope(self):
         if not self.isMicroscopeRunning:
@@ -154,7 +204,15 @@ class Enose():
 
     def sampleMicroscope(self):
         if self.microscopeTimer.isActive():
-            self.microscopeSignals.sampled.emit(self.imageBuffer)
+            with self.frameLock:
+                frame, self.readyFrame = self.readyFrame, None
+            if frame is not None:
+                # The emitted frame belongs to the consumers until the next
+                # one is emitted, anything kept longer must be copied
+                if self.displayedFrame is not None:
+                    self.framePool.release(self.displayedFrame)
+                self.displayedFrame = frame
+                self.microscopeSignals.sampled.emit(frame)
             self.microscopeTimer.start(1)
 
     def stopMicroscope(self):
@@ -199,10 +257,107 @@ class FourStageLowPassFilter:
         return self.y[0]
 
 
+class BaselineDriftCompensator:
+
+    MODES = ("differential", "relative", "fractional")
+
+    def __init__(self, mode="differential", drift_smoothing=0.5):
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown drift compensation mode: {mode}")
+        self.mode = mode
+        self.driftSmoothing = drift_smoothing
+        self.baseline = None
+        self.baselineTime = 0
+        self.driftRate = None
+        # Stands in for the baseline until the first baseline phase ends,
+        # it never contributes to the drift rate
+        self.fallbackBaseline = None
+        self.isEstimating = False
+        self.baselineSum = None
+        self.baselineTimeSum = 0
+        self.baselineCount = 0
+
+    def startBaseline(self):
+        self.isEstimating = True
+        self.baselineSum = None
+        self.baselineTimeSum = 0
+        self.baselineCount = 0
+
+    def endBaseline(self):
+        self.isEstimating = False
+        if self.baselineCount:
+            baseline = self.baselineSum / self.baselineCount
+            baseline_time = self.baselineTimeSum / self.baselineCount
+            # The drift rate is carried from one sample to the next
+            if self.baseline is not None and \
+                    self.baseline.shape == baseline.shape and \
+                    baseline_time > self.baselineTime:
+                rate = (baseline - self.baseline) \
+                    / (baseline_time - self.baselineTime)
+                if self.driftRate is None:
+                    self.driftRate = rate
+                else:
+                    self.driftRate = self.driftSmoothing * rate \
+                        + (1 - self.driftSmoothing) * self.driftRate
+            else:
+                self.driftRate = None
+            self.baseline = baseline
+            self.baselineTime = baseline_time
+
+    def estimateBaseline(self, timestamp):
+        if self.isEstimating and self.baselineCount:
+            return self.baselineSum / self.baselineCount
+        if self.baseline is None:
+            return self.fallbackBaseline
+        if self.driftRate is None:
+            return self.baseline
+        return self.baseline + self.driftRate * (timestamp - self.baselineTime)
+
+    def compensate(self, sample, timestamp):
+        sample = np.asarray(sample, dtype=np.float64)
+        if self.baseline is not None and self.baseline.shape != sample.shape:
+            self.baseline = None
+            self.driftRate = None
+        if self.fallbackBaseline is not None and \
+                self.fallbackBaseline.shape != sample.shape:
+            self.fallbackBaseline = None
+        if self.isEstimating:
+            if self.baselineSum is None or \
+                    self.baselineSum.shape != sample.shape:
+                self.baselineSum = np.zeros_like(sample)
+                self.baselineTimeSum = 0
+                self.baselineCount = 0
+            self.baselineSum += sample
+            self.baselineTimeSum += timestamp
+            self.baselineCount += 1
+        elif self.baseline is None and self.fallbackBaseline is None:
+            self.fallbackBaseline = sample.copy()
+        baseline = self.estimateBaseline(timestamp)
+        if self.mode == "differential":
+            return sample - baseline
+        ratio = np.divide(sample, baseline,
+                          out=np.full_like(sample, np.nan),
+                          where=baseline != 0)
+        if self.mode == "relative":
+            return ratio
+        return ratio - 1
+
+    def state(self):
+        return {"mode": self.mode,
+                "baseline": None if self.baseline is None
+                else self.baseline.tolist(),
+                "drift_rate": None if self.driftRate is None
+                else self.driftRate.tolist()}
+
+
 class BufferSignals(QtCore.QObject):
 
     serial_data_ready = QtCore.pyqtSignal(list)
+    corrected_data_ready = QtCore.pyqtSignal(list)
+    sample_received = QtCore.pyqtSignal(list)
+    channels_named = QtCore.pyqtSignal(list)
     microscope_data_ready = QtCore.pyqtSignal(np.ndarray)
+    roi_color_measured = QtCore.pyqtSignal(list)
     sample_timer_timeout = QtCore.pyqtSignal(int)
     sampling_completed = QtCore.pyqtSignal(tuple)
     baseline_started = QtCore.pyqtSignal()
@@ -217,6 +372,7 @@ class DataBuffer():
         self.signals = BufferSignals()
         self.float_list_data = list()
         self.number_of_arrays = 0
+        self.channelNames = list()
         self.isArrayCreated = False
         self.timeCount = 0
         self.sampleTimer = QtCore.QTimer()
@@ -227,6 +383,15 @@ class DataBuffer():
         self.adsorptionTimer.timeout.connect(self.adsorptionTimeOutCallback)
         self.sampleSettings = dict()
         self.isRecording = False
+        self.recordingStartTime = 0
+        # Replayed sessions keep their recorded timing on their own clock
+        self.clock = time.time
+        self.timeScale = 1.0
+        self.serial_time_array = list()
+        self.image_time_array = list()
+        self.driftCompensator = None
+        self.corrected_buffer_array = list()
+        self.videoRecorder = None
 
         self.imageBuffer = None
         self.rectangleTopLeft = tuple()
@@ -246,8 +411,28 @@ class DataBuffer():
 
     def receiveSerialData(self, enconded_bytes_data=None, seperator=","):
         if enconded_bytes_data:
-            decoded_list_data = enconded_bytes_data.decode().split(seperator)
-            float_list_data = [float(data) for data in decoded_list_data]
+            decoded_list_data = enconded_bytes_data.decode(
+                errors="replace").split(seperator)
+            try:
+                float_list_data = [float(data) for data in decoded_list_data]
+            except ValueError:
+                self.receiveSerialHeader(decoded_list_data)
+                return
+            self.receiveSerialValues(float_list_data)
+
+    def receiveSerialHeader(self, decoded_list_data):
+        names = DataManager.parseChannelNames(decoded_list_data,
+                                              self.number_of_arrays)
+        if names:
+            self.setChannelNames(names)
+
+    def setChannelNames(self, names):
+        if list(names) != self.channelNames:
+            self.channelNames = list(names)
+            self.signals.channels_named.emit(self.channelNames)
+
+    def receiveSerialValues(self, float_list_data, timestamp=None):
+        if float_list_data:
             if not self.isArrayCreated:
                 if len(float_list_data) != self.number_of_arrays:
                     self.number_of_arrays = len(float_list_data)
@@ -255,37 +440,61 @@ class DataBuffer():
                 else:
                     self.serial_buffer_array = [
                         list() for i in range(len(float_list_data))]
+                    self.corrected_buffer_array = [
+                        list() for i in range(len(float_list_data))]
                     self.isArrayCreated = True
             else:
                 for data, buffer in zip(float_list_data,
                                         self.serial_buffer_array):
                     buffer.append(data)
+                # Devices that buffer samples pass their acquisition time
+                now = self.clock() if timestamp is None else timestamp
+                self.serial_time_array.append(now - self.recordingStartTime)
+                self.signals.sample_received.emit(float_list_data)
                 self.signals.serial_data_ready.emit(
                     self.serial_buffer_array)
+                if self.driftCompensator:
+                    corrected = self.driftCompensator.compensate(
+                        float_list_data, now)
+                    for data, buffer in zip(corrected,
+                                            self.corrected_buffer_array):
+                        buffer.append(data)
+                    self.signals.corrected_data_ready.emit(
+                        self.corrected_buffer_array)
 
     def flushSerial(self):
         if self.isArrayCreated:
             self.serial_buffer_array = [list()
                                         for i in range(
                                             self.number_of_arrays)]
+            self.corrected_buffer_array = [list()
+                                           for i in range(
+                                               self.number_of_arrays)]
         else:
             self.serial_buffer_array = list()
+            self.corrected_buffer_array = list()
+        self.serial_time_array = list()
 
     def startRecording(self, sample_settings):
         if not self.isRecording:
             self.timeCount = 0
+            self.recordingStartTime = self.clock()
             self.flushSerial()
             self.flushVideo()
             self.sampleSettings = sample_settings
             self.isRecording = True
+            if self.videoRecorder:
+                self.videoRecorder.start(self.sampleSettings["sample_name"])
             self.baselineTimer.start(
-                1000 * self.sampleSettings["baseline_duration"])
+                self.__interval(self.sampleSettings["baseline_duration"]))
+            if self.driftCompensator:
+                self.driftCompensator.startBaseline()
             self.signals.baseline_started.emit()
             self.imageTimerCallback()
             self.sampleTimeoutCallback()
-            self.sampleTimer.start(1000)
-            self.imageTimer.start(1000 * self.sampleSettings[
-                "video_interval"])
+            self.sampleTimer.start(self.__interval(1))
+            self.imageTimer.start(self.__interval(self.sampleSettings[
+                "video_interval"]))
 
     def stopRecording(self):
         if self.isRecording:
@@ -294,15 +503,28 @@ class DataBuffer():
                 self.sampleTimer.stop()
             if self.baselineTimer.isActive():
                 self.baselineTimer.stop()
+                if self.driftCompensator:
+                    self.driftCompensator.endBaseline()
             if self.adsorptionTimer.isActive():
                 self.adsorptionTimer.stop()
             if self.imageTimer.isActive():
                 self.imageTimer.stop()
+            if self.videoRecorder:
+                self.videoRecorder.stop()
             self.isRecording = False
             self.signals.sampling_completed.emit(
                 (self.sampleSettings["sample_name"],
                  self.serial_buffer_array,
-                 self.image_buffer_array))
+                 self.image_buffer_array,
+                 {"sample_settings": self.sampleSettings,
+                  "channel_names": DataManager.channelNames(
+                      len(self.serial_buffer_array), self.channelNames),
+                  "serial_timestamps": self.serial_time_array,
+                  "image_timestamps": self.image_time_array,
+                  "drift_compensation": self.driftCompensator.state()
+                  if self.driftCompensator else None},
+                 self.corrected_buffer_array
+                 if self.driftCompensator else None))
 
     def sampleTimeoutCallback(self):
         self.signals.sample_timer_timeout.emit(self.timeCount)
@@ -313,14 +535,28 @@ class DataBuffer():
 
     def baselineTimeOutCallback(self):
         self.baselineTimer.stop()
+        if self.driftCompensator:
+            self.driftCompensator.endBaseline()
         self.signals.adsorption_started.emit()
         self.adsorptionTimer.start(
-            self.sampleSettings["adsorption_duration"] * 1000)
+            self.__interval(self.sampleSettings["adsorption_duration"]))
 
     def adsorptionTimeOutCallback(self):
         self.adsorptionTimer.stop()
         self.signals.desorption_started.emit()
 
+    def __interval(self, seconds):
+        return max(1, int(1000 * seconds / self.timeScale))
+
+    def endAdsorption(self):
+        if self.adsorptionTimer.isActive():
+            # The skipped adsorption time is taken off the whole sample
+            skipped = int(self.adsorptionTimer.remainingTime()
+                          * self.timeScale) // 1000
+            self.sampleSettings["adsorption_duration"] -= skipped
+            self.sampleSettings["sample_duration"] -= skipped
+            self.adsorptionTimeOutCallback()
+
     def receiveImageData(self, image):
         rows = image.shape[0]
         columns = image.shape[1]
@@ -334,10 +570,18 @@ class DataBuffer():
             rectangleFrameCenter[1] + self.rectangleWidth//2,
             rectangleFrameCenter[0] + self.rectangleHeight//2)
 
-        self.imageBuffer = image.copy()
-        self.imageBuffer = self.imageBuffer[
+        self.imageBuffer = image[
             rectangleFrameTopLeft[1]:rectangleFrameBottomRight[1],
-            rectangleFrameTopLeft[0]:rectangleFrameBottomRight[0]]
+            rectangleFrameTopLeft[0]:rectangleFrameBottomRight[0]].copy()
+        if self.imageBuffer.size:
+            self.signals.roi_color_measured.emit(
+                list(self.__mean(self.imageBuffer)))
+        if self.isRecording and self.videoRecorder:
+            timestamp = self.clock() - self.recordingStartTime
+            if self.videoRecorder.mode == "full":
+                self.videoRecorder.write(image.copy(), timestamp)
+            elif self.imageBuffer.size:
+                self.videoRecorder.write(self.imageBuffer, timestamp)
         cv2.rectangle(image,
                       rectangleFrameTopLeft,
                       rectangleFrameBottomRight,
@@ -379,10 +623,12 @@ class DataBuffer():
 
     def flushVideo(self):
         self.image_buffer_array = list()
+        self.image_time_array = list()
 
     def imageTimerCallback(self):
         self.image_buffer_array.append(
             self.imageBuffer)
+        self.image_time_array.append(self.clock() - self.recordingStartTime)
         self.signals.image_captured.emit(self.timeCount)
 
     def moveRectangleUp(self):
@@ -412,14 +658,33 @@ class DataBuffer():
 
 class DataManager():
 
-    CHANNEL_NAMES = ["Channel 1",
-                     "Channel 2",
-                     "Channel 3",
-                     "Channel 4",
-                     "Channel 5",
-                     "Channel 6",
-                     "Channel 7",
-                     "Channel 8"]
+    HEADER_PREFIX = "#"
+
+    @staticmethod
+    def channelNames(count, names=()):
+        names = list(names)[:count]
+        return names + [f"Channel {i+1}" for i in range(len(names), count)]
+
+    @classmethod
+    def parseChannelNames(cls, fields, width=0):
+        # Boards announce their channel names in a header line such as
+        # "#TGS2600,TGS2602,...". Without the prefix a line is only taken
+        # as a header when it is as wide as the data, so boot banners and
+        # error messages are not mistaken for names
+        names = [field.strip() for field in fields]
+        if names and names[0].startswith(cls.HEADER_PREFIX):
+            names[0] = names[0][len(cls.HEADER_PREFIX):].strip()
+        elif not width or len(names) != width:
+            return None
+        for name in names:
+            if not name or "\ufffd" in name:
+                return None
+            try:
+                float(name)
+                return None
+            except ValueError:
+                pass
+        return names
 
     def __init__(self):
         self.currentPath = os.getcwd()
@@ -436,16 +701,27 @@ class DataManager():
         if not os.path.exists(sample_path):
             os.makedirs(sample_path)
         serial_data = sample_info[1]
-        dataset = pd.DataFrame()
-        for data, channelName in zip(serial_data,
-                                     self.CHANNEL_NAMES):
-            dataset[channelName] = data
+        session = sample_info[3] if len(sample_info) > 3 else dict()
+        channel_names = self.channelNames(len(serial_data),
+                                          session.get("channel_names", ()))
+        # Boards can repeat sensor models, so names need not be unique
+        dataset = pd.DataFrame(np.column_stack(serial_data),
+                               columns=channel_names) \
+            if serial_data else pd.DataFrame()
 
         with open(os.path.join(sample_path,
                                "serialdata.csv"),
                   'w') as file:
             dataset.to_csv(path_or_buf=file)
 
+        if len(sample_info) > 4 and sample_info[4]:
+            corrected_dataset = pd.DataFrame(
+                np.column_stack(sample_info[4]), columns=channel_names)
+            with open(os.path.join(sample_path,
+                                   "serialdata_corrected.csv"),
+                      'w') as file:
+                corrected_dataset.to_csv(path_or_buf=file)
+
         image_folder_name = "images"
         image_folder_path = os.path.join(sample_path,
                                          image_folder_name)
@@ -459,6 +735,12 @@ class DataManager():
                                cv2.COLOR_BGR2RGB)
             cv2.imwrite(fileName, img)
 
+        if len(sample_info) > 3:
+            with open(os.path.join(sample_path,
+                                   "session.json"),
+                      'w') as file:
+                json.dump(sample_info[3], file)
+
 
 if __name__ == "__main__":
     dm = DataManager()
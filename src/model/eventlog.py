@@ -0,0 +1,54 @@
+import os
+import json
+import queue
+import threading
+import time
+
+
+class SessionEventLog():
+
+    def __init__(self, dataset_path):
+        self.datasetPath = dataset_path
+        self.records = None
+        self.thread = None
+        self.isLogging = False
+
+    def start(self, sample_settings):
+        if not self.isLogging:
+            sample_path = os.path.join(self.datasetPath,
+                                       sample_settings["sample_name"])
+            if not os.path.exists(sample_path):
+                os.makedirs(sample_path)
+            self.records = queue.Queue()
+            self.thread = threading.Thread(
+                target=self.writeLoop,
+                args=(os.path.join(sample_path, "events.jsonl"),),
+                daemon=True)
+            self.thread.start()
+            self.isLogging = True
+            self.record("Event", "Session Started",
+                        sample_settings=sample_settings)
+
+    def stop(self):
+        if self.isLogging:
+            self.record("Event", "Session Closed")
+            self.isLogging = False
+            self.records.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def record(self, level, message, **fields):
+        if self.isLogging:
+            self.records.put(dict(time=time.time(), level=level,
+                                  message=message, **fields))
+
+    def writeLoop(self, path):
+        with open(path, 'w') as file:
+            while True:
+                record = self.records.get()
+                if record is None:
+                    break
+                file.write(json.dumps(record) + "\n")
+                # Flush once the pending records are written
+                if self.records.empty():
+                    file.flush()
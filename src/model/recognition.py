@@ -0,0 +1,256 @@
+import os
+import re
+import sys
+import json
+import numpy as np
+import pandas as pd
+import cv2
+from PyQt5 import QtCore
+
+
+class OdorFeatureTracker:
+
+    COLOR_CHANNELS = 3
+
+    def __init__(self):
+        self.phase = None
+        self.reset()
+
+    def reset(self):
+        self.baselineSum = None
+        self.baselineCount = 0
+        self.responseSum = None
+        self.responsePeak = None
+        self.lastResponse = None
+        self.responseCount = 0
+        self.colorBaselineSum = np.zeros(self.COLOR_CHANNELS)
+        self.colorBaselineCount = 0
+        self.colorSum = np.zeros(self.COLOR_CHANNELS)
+        self.lastColor = np.zeros(self.COLOR_CHANNELS)
+        self.colorCount = 0
+
+    def startBaseline(self):
+        self.reset()
+        self.phase = "baseline"
+
+    def startAdsorption(self):
+        self.phase = "adsorption"
+
+    def stop(self):
+        self.phase = None
+
+    def addSample(self, sample):
+        sample = np.asarray(sample, dtype=np.float64)
+        if self.phase == "baseline":
+            if self.baselineSum is None or \
+                    self.baselineSum.shape != sample.shape:
+                self.baselineSum = np.zeros_like(sample)
+                self.baselineCount = 0
+            self.baselineSum += sample
+            self.baselineCount += 1
+        elif self.phase == "adsorption" and self.baselineCount and \
+                self.baselineSum.shape == sample.shape:
+            baseline = self.baselineSum / self.baselineCount
+            response = np.divide(sample - baseline, baseline,
+                                 out=np.zeros_like(sample),
+                                 where=baseline != 0)
+            if self.responseCount:
+                self.responseSum += response
+                self.responsePeak = np.where(
+                    np.abs(response) > np.abs(self.responsePeak),
+                    response, self.responsePeak)
+            else:
+                self.responseSum = response.copy()
+                self.responsePeak = response.copy()
+            self.lastResponse = response
+            self.responseCount += 1
+            return True
+        return False
+
+    def addColor(self, color):
+        color = np.asarray(color[:self.COLOR_CHANNELS], dtype=np.float64)
+        if self.phase == "baseline":
+            self.colorBaselineSum += color
+            self.colorBaselineCount += 1
+        elif self.phase == "adsorption" and self.colorBaselineCount:
+            self.lastColor = (color - self.colorBaselineSum
+                              / self.colorBaselineCount) / 255
+            self.colorSum += self.lastColor
+            self.colorCount += 1
+
+    def features(self):
+        if not self.responseCount:
+            return None
+        color_mean = self.colorSum / self.colorCount if self.colorCount \
+            else self.colorSum
+        return np.concatenate([self.lastResponse,
+                               self.responsePeak,
+                               self.responseSum / self.responseCount,
+                               self.lastColor,
+                               color_mean])
+
+
+class OdorClassifier:
+
+    def __init__(self, mean, scale, components, centroids, spread, labels):
+        self.mean = mean
+        self.scale = scale
+        self.components = components
+        self.centroids = centroids
+        self.spread = spread
+        self.labels = labels
+
+    @classmethod
+    def fit(cls, features, labels, n_components=3):
+        features = np.asarray(features, dtype=np.float64)
+        labels = np.asarray(labels)
+        mean = features.mean(axis=0)
+        scale = features.std(axis=0)
+        scale[scale == 0] = 1
+        standardized = (features - mean) / scale
+        n_components = min(n_components, *standardized.shape)
+        components = np.linalg.svd(standardized,
+                                   full_matrices=False)[2][:n_components]
+        projected = standardized @ components.T
+        classes = np.unique(labels)
+        centroids = np.array([projected[labels == label].mean(axis=0)
+                              for label in classes])
+        residuals = projected - centroids[np.searchsorted(classes, labels)]
+        spread = max(float(np.mean(np.sum(residuals**2, axis=1))), 1e-12)
+        return cls(mean, scale, components, centroids, spread, classes)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as model:
+            return cls(model["mean"], model["scale"], model["components"],
+                       model["centroids"], float(model["spread"]),
+                       model["labels"])
+
+    def save(self, path):
+        np.savez(path, mean=self.mean, scale=self.scale,
+                 components=self.components, centroids=self.centroids,
+                 spread=self.spread, labels=self.labels)
+
+    def predict(self, features):
+        projected = ((features - self.mean) / self.scale) @ self.components.T
+        distances = np.sum((self.centroids - projected)**2, axis=1) \
+            / self.spread
+        likelihoods = np.exp(-(distances - distances.min()) / 2)
+        probabilities = likelihoods / likelihoods.sum()
+        best = int(np.argmax(probabilities))
+        return str(self.labels[best]), float(probabilities[best])
+
+
+def labelFromSampleName(sample_name):
+    # "ethanol_03" and "ethanol 3" are both samples of "ethanol"
+    return re.sub(r"[\s_-]*\d+$", "", sample_name) or sample_name
+
+
+def sessionFeatures(sample_path, max_snapshots=20):
+    with open(os.path.join(sample_path, "session.json")) as file:
+        session = json.load(file)
+    settings = session["sample_settings"]
+    samples = pd.read_csv(os.path.join(sample_path, "serialdata.csv"),
+                          index_col=0).to_numpy(dtype=np.float64)
+    sample_times = session["serial_timestamps"]
+    image_times = session["image_timestamps"]
+    image_folder_path = os.path.join(sample_path, "images")
+    events = [(sample_time, 0, index)
+              for index, sample_time in enumerate(sample_times)]
+    events += [(image_time, 1, index)
+               for index, image_time in enumerate(image_times)]
+    events.sort()
+
+    adsorption_start = settings["baseline_duration"]
+    adsorption_end = adsorption_start + settings["adsorption_duration"]
+    tracker = OdorFeatureTracker()
+    tracker.startBaseline()
+    snapshots = list()
+    for event_time, kind, index in events:
+        if event_time >= adsorption_end:
+            break
+        if event_time >= adsorption_start and tracker.phase == "baseline":
+            tracker.startAdsorption()
+        if kind == 1:
+            image = cv2.imread(os.path.join(image_folder_path,
+                                            f"{index+1}.jpg"))
+            if image is not None:
+                tracker.addColor(cv2.mean(image)[2::-1])
+        elif tracker.addSample(samples[index]):
+            snapshots.append(tracker.features())
+    if len(snapshots) > max_snapshots:
+        picks = np.linspace(0, len(snapshots) - 1, max_snapshots)
+        snapshots = [snapshots[int(pick)] for pick in picks]
+    return settings["sample_name"], snapshots
+
+
+def trainFromDatasets(dataset_path, n_components=3):
+    features = list()
+    labels = list()
+    for name in sorted(os.listdir(dataset_path)):
+        sample_path = os.path.join(dataset_path, name)
+        if not os.path.exists(os.path.join(sample_path, "session.json")):
+            continue
+        sample_name, snapshots = sessionFeatures(sample_path)
+        features += snapshots
+        labels += [labelFromSampleName(sample_name)] * len(snapshots)
+    return OdorClassifier.fit(features, labels, n_components)
+
+
+class RecognitionSignals(QtCore.QObject):
+
+    predicted = QtCore.pyqtSignal(str, float)
+    confident = QtCore.pyqtSignal(str)
+
+
+class OdorRecognizer():
+
+    def __init__(self, classifier, confidence_threshold=0.9, hold_count=5):
+        self.signals = RecognitionSignals()
+        self.classifier = classifier
+        self.tracker = OdorFeatureTracker()
+        self.confidenceThreshold = confidence_threshold
+        self.holdCount = hold_count
+        self.lastLabel = None
+        self.confidentCount = 0
+        self.isConfident = False
+
+    def startBaseline(self):
+        self.tracker.startBaseline()
+        self.lastLabel = None
+        self.confidentCount = 0
+        self.isConfident = False
+
+    def startAdsorption(self):
+        self.tracker.startAdsorption()
+
+    def stop(self):
+        self.tracker.stop()
+
+    def receiveColor(self, color):
+        self.tracker.addColor(color)
+
+    def receiveSample(self, float_list_data):
+        if not self.tracker.addSample(float_list_data):
+            return
+        features = self.tracker.features()
+        if features.shape != self.classifier.mean.shape:
+            return
+        label, confidence = self.classifier.predict(features)
+        self.signals.predicted.emit(label, confidence)
+        if confidence < self.confidenceThreshold:
+            self.confidentCount = 0
+        elif label == self.lastLabel:
+            self.confidentCount += 1
+        else:
+            self.confidentCount = 1
+        self.lastLabel = label
+        if self.confidentCount >= self.holdCount and not self.isConfident:
+            self.isConfident = True
+            self.signals.confident.emit(label)
+
+
+if __name__ == "__main__":
+    classifier = trainFromDatasets(sys.argv[1])
+    classifier.save(sys.argv[2])
+    print("Trained on", ", ".join(classifier.labels))
@@ -0,0 +1,97 @@
+import os
+import csv
+import queue
+import threading
+import cv2
+from PyQt5 import QtCore
+
+
+class RecorderSignals(QtCore.QObject):
+
+    failed = QtCore.pyqtSignal(str)
+
+
+class VideoRecorder():
+
+    MODES = ("roi", "full")
+
+    def __init__(self, dataset_path, mode="roi", fps=30, fourcc="mp4v",
+                 max_pending=64):
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown video recording mode: {mode}")
+        self.datasetPath = dataset_path
+        self.mode = mode
+        self.fps = fps
+        self.fourcc = cv2.VideoWriter_fourcc(*fourcc)
+        self.codec = fourcc
+        self.signals = RecorderSignals()
+        self.maxPending = max_pending
+        self.frames = None
+        self.thread = None
+        self.droppedFrames = 0
+        self.isRecording = False
+
+    def start(self, sample_name):
+        if not self.isRecording:
+            sample_path = os.path.join(self.datasetPath, sample_name)
+            if not os.path.exists(sample_path):
+                os.makedirs(sample_path)
+            self.frames = queue.Queue(self.maxPending)
+            self.droppedFrames = 0
+            self.thread = threading.Thread(target=self.recordLoop,
+                                           args=(sample_path,),
+                                           daemon=True)
+            self.thread.start()
+            self.isRecording = True
+
+    def write(self, frame, timestamp):
+        # The frame must not be modified by the caller afterwards
+        if self.isRecording:
+            try:
+                self.frames.put_nowait((timestamp, frame))
+            except queue.Full:
+                self.droppedFrames += 1
+
+    def stop(self):
+        if self.isRecording:
+            self.isRecording = False
+            self.frames.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def recordLoop(self, sample_path):
+        writer = None
+        frame_size = None
+        is_failed = False
+        with open(os.path.join(sample_path, "video_index.csv"), 'w',
+                  newline='') as file:
+            index = csv.writer(file)
+            index.writerow(["frame", "timestamp"])
+            frame_number = 0
+            while True:
+                item = self.frames.get()
+                if item is None:
+                    break
+                if is_failed:
+                    # Keep draining so that stop() never blocks
+                    continue
+                timestamp, frame = item
+                if writer is None:
+                    frame_size = (frame.shape[1], frame.shape[0])
+                    writer = cv2.VideoWriter(
+                        os.path.join(sample_path, "video.mp4"),
+                        self.fourcc, self.fps, frame_size)
+                    if not writer.isOpened():
+                        is_failed = True
+                        self.signals.failed.emit(
+                            f"Video recording failed, OpenCV cannot "
+                            f"encode {self.codec}")
+                        continue
+                # The ROI can be resized while recording
+                if (frame.shape[1], frame.shape[0]) != frame_size:
+                    frame = cv2.resize(frame, frame_size)
+                writer.write(cv2.cvtColor(frame, cv2.COLOR_RGB2BGR))
+                index.writerow([frame_number, f"{timestamp:.4f}"])
+                frame_number += 1
+        if writer is not None:
+            writer.release()
@@ -0,0 +1,197 @@
+import os
+import json
+import time
+import numpy as np
+import pandas as pd
+import cv2
+from PyQt5 import QtCore
+from model.devices import SerialDeviceSignals, MicroscopeSignals
+
+
+class RecordedSession():
+
+    def __init__(self, sample_path):
+        self.samplePath = sample_path
+        dataset = pd.read_csv(os.path.join(sample_path, "serialdata.csv"),
+                              index_col=0)
+        self.channelNames = list(dataset.columns)
+        self.samples = dataset.to_numpy(dtype=np.float64)
+
+        image_folder_path = os.path.join(sample_path, "images")
+        if os.path.exists(image_folder_path):
+            image_names = [name for name in os.listdir(image_folder_path)
+                           if name.endswith(".jpg")]
+            image_names.sort(key=lambda name: int(name[:-4]))
+        else:
+            image_names = list()
+        self.imagePaths = [os.path.join(image_folder_path, name)
+                           for name in image_names]
+
+        session_path = os.path.join(sample_path, "session.json")
+        if os.path.exists(session_path):
+            with open(session_path) as file:
+                session = json.load(file)
+        else:
+            session = dict()
+        # pandas renames repeated column names, the session keeps them
+        channel_names = session.get("channel_names")
+        if channel_names and len(channel_names) == len(self.channelNames):
+            self.channelNames = list(channel_names)
+        self.sampleSettings = session.get("sample_settings", dict())
+        self.sampleTimes = np.asarray(
+            session.get("serial_timestamps", list()), dtype=np.float64)
+        self.imageTimes = np.asarray(
+            session.get("image_timestamps", list()), dtype=np.float64)
+        # Sessions recorded before timestamps were saved are assumed to
+        # be sampled once per second with evenly spaced images
+        if len(self.sampleTimes) != len(self.samples):
+            self.sampleTimes = np.arange(len(self.samples), dtype=np.float64)
+        if len(self.imageTimes) != len(self.imagePaths):
+            interval = self.sampleSettings.get("video_interval")
+            if not interval and len(self.imagePaths):
+                interval = max(len(self.samples), 1) / len(self.imagePaths)
+            self.imageTimes = interval * np.arange(len(self.imagePaths),
+                                                   dtype=np.float64)
+
+    def readImage(self, index):
+        return cv2.cvtColor(cv2.imread(self.imagePaths[index]),
+                            cv2.COLOR_BGR2RGB)
+
+
+class ReplayTask():
+
+    def __init__(self, times, emit_func, speed=1.0, batch_size=100):
+        self.times = times
+        self.emit_func = emit_func
+        self.speed = speed
+        self.batchSize = batch_size
+        self.index = 0
+        self.startTime = 0
+        self.timer = QtCore.QTimer()
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.step)
+
+    def start(self):
+        if self.times is not None and len(self.times):
+            self.index = 0
+            # Recorded times are relative to the start of the recording
+            self.startTime = time.monotonic() - self.times[0] / self.speed \
+                if self.speed else 0
+            self.timer.start(0)
+
+    def stop(self):
+        self.timer.stop()
+
+    def isActive(self):
+        return self.timer.isActive()
+
+    def elapsed(self):
+        # Recorded time reached so far, the last sample at full speed
+        if self.speed:
+            return (time.monotonic() - self.startTime) * self.speed
+        return self.times[self.index - 1] if self.index else 0
+
+    def step(self):
+        if self.speed:
+            elapsed = (time.monotonic() - self.startTime) * self.speed
+            while self.index < len(self.times) and \
+                    self.times[self.index] <= elapsed:
+                self.emit_func(self.index)
+                self.index += 1
+        else:
+            # As fast as possible, in batches to keep the GUI responsive
+            end = min(self.index + self.batchSize, len(self.times))
+            while self.index < end:
+                self.emit_func(self.index)
+                self.index += 1
+        if self.index < len(self.times):
+            if self.speed:
+                self.timer.start(max(0, int(
+                    1000 * (self.times[self.index] - elapsed) / self.speed)))
+            else:
+                self.timer.start(0)
+
+
+class ReplayDevice():
+
+    def __init__(self, dataset_path, speed=1.0):
+        self.datasetPath = dataset_path
+        self.speed = speed
+        self.session = None
+        self.replayStartTime = 0
+        self.serialSignals = SerialDeviceSignals()
+        self.serialReplayTask = ReplayTask(None, self.emitSample, speed)
+        self.isSerialRunning = False
+        self.isMicroscopeOpen = False
+        self.microscopeSignals = MicroscopeSignals()
+        self.microscopeReplayTask = ReplayTask(None, self.emitImage, speed)
+        self.isMicroscopeRunning = False
+
+    def searchSerial(self):
+        sessions = [name for name in sorted(os.listdir(self.datasetPath))
+                    if os.path.exists(os.path.join(self.datasetPath, name,
+                                                   "serialdata.csv"))]
+        self.serialSignals.port_found.emit(sessions)
+
+    def openSerial(self, deviceSettings):
+        if not self.session:
+            self.session = RecordedSession(
+                os.path.join(self.datasetPath, deviceSettings["port"]))
+            self.serialReplayTask.times = self.session.sampleTimes
+            self.microscopeReplayTask.times = self.session.imageTimes
+            self.serialSignals.connected.emit()
+            self.serialSignals.channels_named.emit(self.session.channelNames)
+
+    def closeSerial(self):
+        if self.session:
+            self.stopSerial()
+            self.closeMicroscope()
+            self.session = None
+            self.serialSignals.disconnected.emit()
+
+    def writeSerial(self, string_data):
+        pass
+
+    def runSerial(self, sample_interval):
+        if self.session and not self.isSerialRunning:
+            self.replayStartTime = time.time()
+            self.serialReplayTask.start()
+            self.isSerialRunning = True
+
+    def emitSample(self, index):
+        self.serialSignals.parsed.emit(
+            self.session.samples[index].tolist(),
+            self.replayStartTime + self.session.sampleTimes[index])
+
+    def clock(self):
+        # Replayed samples are stamped with their recorded timing
+        if self.isSerialRunning:
+            return self.replayStartTime + self.serialReplayTask.elapsed()
+        return time.time()
+
+    def stopSerial(self):
+        self.isSerialRunning = False
+        self.serialReplayTask.stop()
+
+    def openMicroscope(self, videoport):
+        if self.session and not self.isMicroscopeOpen:
+            self.isMicroscopeOpen = True
+            self.microscopeSignals.connected.emit()
+
+    def closeMicroscope(self):
+        if self.isMicroscopeOpen:
+            self.stopMicroscope()
+            self.isMicroscopeOpen = False
+            self.microscopeSignals.disconnected.emit()
+
+    def runMicroscope(self):
+        if self.isMicroscopeOpen and not self.isMicroscopeRunning:
+            self.microscopeReplayTask.start()
+            self.isMicroscopeRunning = True
+
+    def emitImage(self, index):
+        self.microscopeSignals.sampled.emit(self.session.readImage(index))
+
+    def stopMicroscope(self):
+        self.isMicroscopeRunning = False
+        self.microscopeReplayTask.stop()
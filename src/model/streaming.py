@@ -0,0 +1,200 @@
+import collections
+import os
+import socket
+import struct
+import threading
+import time
+import numpy as np
+import cv2
+
+
+# Every message is a header followed by its payload:
+#   header   <B d I   kind, time.time() of publication, payload length
+#   SAMPLES  <H H     rows, channels, then rows * channels float64 values
+#   EVENT             utf-8 event name
+#   FRAME    <H H B   rows, columns, color channels, then uint8 pixels
+HEADER = struct.Struct("<BdI")
+SAMPLES_HEADER = struct.Struct("<HH")
+FRAME_HEADER = struct.Struct("<HHB")
+
+SAMPLES = 1
+EVENT = 2
+FRAME = 3
+
+DROP_OLDEST = "drop_oldest"
+DROP_NEWEST = "drop_newest"
+DISCONNECT = "disconnect"
+
+
+class Subscriber():
+
+    def __init__(self, connection, max_pending=256, drop_policy=DROP_OLDEST):
+        self.connection = connection
+        self.maxPending = max_pending
+        self.dropPolicy = drop_policy
+        self.pending = collections.deque()
+        self.condition = threading.Condition()
+        self.droppedMessages = 0
+        self.isRunning = True
+        self.thread = threading.Thread(target=self.sendLoop, daemon=True)
+        self.thread.start()
+
+    def enqueue(self, message):
+        with self.condition:
+            if len(self.pending) >= self.maxPending:
+                self.droppedMessages += 1
+                if self.dropPolicy == DROP_NEWEST:
+                    return
+                elif self.dropPolicy == DISCONNECT:
+                    self.isRunning = False
+                    self.condition.notify()
+                    return
+                self.pending.popleft()
+            self.pending.append(message)
+            self.condition.notify()
+
+    def sendLoop(self):
+        while True:
+            with self.condition:
+                while self.isRunning and not self.pending:
+                    self.condition.wait()
+                if not self.isRunning:
+                    break
+                message = self.pending.popleft()
+            try:
+                self.connection.sendall(message)
+            except OSError:
+                break
+        self.isRunning = False
+        self.connection.close()
+
+    def stop(self):
+        with self.condition:
+            self.isRunning = False
+            self.condition.notify()
+
+
+class LiveDataServer():
+
+    def __init__(self, address, family=socket.AF_INET, max_pending=256,
+                 drop_policy=DROP_OLDEST, flush_interval=0.1,
+                 frame_width=160, frame_interval=0.2):
+        self.address = address
+        self.family = family
+        self.maxPending = max_pending
+        self.dropPolicy = drop_policy
+        self.flushInterval = flush_interval
+        self.frameWidth = frame_width
+        self.frameInterval = frame_interval
+        self.lastFrameTime = 0
+        self.subscribers = list()
+        self.subscribersLock = threading.Lock()
+        self.pendingSamples = list()
+        self.samplesLock = threading.RLock()
+        self.serverSocket = None
+        self.isRunning = False
+
+    def start(self):
+        if not self.isRunning:
+            if self.family == socket.AF_UNIX and \
+                    os.path.exists(self.address):
+                os.remove(self.address)
+            self.serverSocket = socket.socket(self.family, socket.SOCK_STREAM)
+            if self.family == socket.AF_INET:
+                self.serverSocket.setsockopt(socket.SOL_SOCKET,
+                                             socket.SO_REUSEADDR, 1)
+            self.serverSocket.bind(self.address)
+            self.serverSocket.listen()
+            self.isRunning = True
+            threading.Thread(target=self.acceptLoop, daemon=True).start()
+            threading.Thread(target=self.flushLoop, daemon=True).start()
+
+    def stop(self):
+        if self.isRunning:
+            self.isRunning = False
+            # close() alone does not wake up a blocked accept() on Linux
+            try:
+                self.serverSocket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.serverSocket.close()
+            with self.subscribersLock:
+                for subscriber in self.subscribers:
+                    subscriber.stop()
+                self.subscribers = list()
+            if self.family == socket.AF_UNIX and \
+                    os.path.exists(self.address):
+                os.remove(self.address)
+
+    def acceptLoop(self):
+        while self.isRunning:
+            try:
+                connection, address = self.serverSocket.accept()
+            except OSError:
+                break
+            if self.family == socket.AF_INET:
+                connection.setsockopt(socket.IPPROTO_TCP,
+                                      socket.TCP_NODELAY, 1)
+            with self.subscribersLock:
+                self.subscribers.append(Subscriber(connection,
+                                                   self.maxPending,
+                                                   self.dropPolicy))
+
+    def flushLoop(self):
+        while self.isRunning:
+            time.sleep(self.flushInterval)
+            self.flushSamples()
+
+    def publish(self, kind, payload):
+        message = HEADER.pack(kind, time.time(), len(payload)) + payload
+        with self.subscribersLock:
+            self.subscribers = [subscriber
+                                for subscriber in self.subscribers
+                                if subscriber.isRunning]
+            for subscriber in self.subscribers:
+                subscriber.enqueue(message)
+
+    def publishSample(self, float_list_data):
+        with self.samplesLock:
+            self.pendingSamples.append(float_list_data)
+
+    def flushSamples(self):
+        # Publishing under the lock keeps batches and events in order
+        # between the flush thread and the GUI thread
+        with self.samplesLock:
+            samples, self.pendingSamples = self.pendingSamples, list()
+            # A change in channel count starts a new batch
+            while samples:
+                channels = len(samples[0])
+                rows = 1
+                while rows < len(samples) and \
+                        len(samples[rows]) == channels:
+                    rows += 1
+                batch = np.asarray(samples[:rows], dtype="<f8")
+                self.publish(SAMPLES,
+                             SAMPLES_HEADER.pack(rows, channels)
+                             + batch.tobytes())
+                samples = samples[rows:]
+
+    def publishEvent(self, name):
+        with self.samplesLock:
+            self.flushSamples()
+            self.publish(EVENT, name.encode("utf-8"))
+
+    def publishFrame(self, image):
+        now = time.monotonic()
+        if not self.frameWidth or now - self.lastFrameTime < \
+                self.frameInterval or not self.subscribers:
+            return
+        self.lastFrameTime = now
+        rows, columns = image.shape[:2]
+        if columns > self.frameWidth:
+            rows = max(1, rows * self.frameWidth // columns)
+            columns = self.frameWidth
+            image = cv2.resize(image, (columns, rows),
+                               interpolation=cv2.INTER_AREA)
+        image = np.ascontiguousarray(image, dtype=np.uint8)
+        channels = image.shape[2] if image.ndim == 3 else 1
+        self.publish(FRAME,
+                     FRAME_HEADER.pack(rows, columns, channels)
+                     + image.tobytes())
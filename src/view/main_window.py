@@ -6,6 +6,21 @@ import pyqtgraph
 pyqtgraph.setConfigOptions(imageAxisOrder="row-major")
 
 
+class PreviewImageItem(pyqtgraph.ImageItem):
+
+    def __init__(self):
+        pyqtgraph.ImageItem.__init__(self)
+        self.isPainted = True
+
+    def setImage(self, image=None, **kwargs):
+        self.isPainted = False
+        pyqtgraph.ImageItem.setImage(self, image, **kwargs)
+
+    def paint(self, painter, *args):
+        pyqtgraph.ImageItem.paint(self, painter, *args)
+        self.isPainted = True
+
+
 class MainWindow(QtWidgets.QMainWindow):
 
     serial_opened = QtCore.pyqtSignal(dict)
@@ -33,7 +48,11 @@ class MainWindow(QtWidgets.QMainWindow):
     height_increased = QtCore.pyqtSignal()
     height_decreased = QtCore.pyqtSignal()
 
-    ChannelNames = ["Channel " + str(i+1) for i in range(8)]
+    event_logged = QtCore.pyqtSignal(str, str)
+
+    ChannelsPerPage = 8
+    MaximumLogLines = 1000
+    LogInterval = 200
     ChannelColors = ["#FF0000",
                      "#FFFF00",
                      "#FF00FF",
@@ -51,10 +70,24 @@ class MainWindow(QtWidgets.QMainWindow):
         ui_path = os.path.join(view_path, "main_window.ui")
         uic.loadUi(ui_path, self)
         self.graphWidget = pyqtgraph.PlotWidget()
+        self.channelNames = ["Channel " + str(i+1) for i in range(8)]
+        self.channelPage = 0
+        self.lines = list()
+        self.lastData = list()
+        self.correctedGraphWidget = None
+        self.correctedLines = list()
+        self.lastCorrectedData = list()
+        self.predictionLabel = None
+        self.earlyStopCheckBox = None
         self.imageWidget = pyqtgraph.GraphicsLayoutWidget()
         self.imageViewBox = self.imageWidget.addViewBox(
             row=0, col=0, invertY=True, invertX=False)
-        self.imageItem = pyqtgraph.ImageItem()
+        self.imageItem = PreviewImageItem()
+        self.isPreviewScaled = True
+        self.previewBuffer = None
+        self.pendingLogLines = list()
+        self.logTimer = QtCore.QTimer()
+        self.logTimer.timeout.connect(self.__flushLog)
         self.imageViewBox.addItem(self.imageItem)
 
         self.graphSettingsOkButton.clicked.connect(
@@ -94,11 +127,119 @@ class MainWindow(QtWidgets.QMainWindow):
         # variables
 
     def showData(self, data_array):
-        for i in range(len(data_array)):
-            self.lines[i].setData(data_array[i])
+        self.lastData = data_array
+        self.__showChannels(data_array)
+
+    def showCorrectedData(self, data_array):
+        self.lastCorrectedData = data_array
+        self.__showChannels(data_array, corrected=True)
+
+    def setChannels(self, names):
+        self.channelNames = list(names)
+        pages = max(1, -(-len(self.channelNames) // self.ChannelsPerPage))
+        self.channelPage = min(self.channelPage, pages - 1)
+        self.channelPageSpinBox.setMaximum(pages)
+        self.channelPageWidget.setVisible(pages > 1)
+        self.lines = self.__plotChannels(self.graphWidget, self.lines)
+        if self.correctedGraphWidget:
+            self.correctedLines = self.__plotChannels(
+                self.correctedGraphWidget, self.correctedLines)
+
+    def __showChannels(self, data_array, corrected=False):
+        if len(data_array) != len(self.channelNames):
+            self.setChannels(
+                self.channelNames[:len(data_array)]
+                + ["Channel " + str(i+1)
+                   for i in range(len(self.channelNames), len(data_array))])
+        lines = self.correctedLines if corrected else self.lines
+        # Only the channels of the selected group are drawn
+        first = self.channelPage * self.ChannelsPerPage
+        for line, data in zip(lines,
+                              data_array[first:first + self.ChannelsPerPage]):
+            line.setData(data)
+
+    def __plotChannels(self, graphWidget, lines):
+        for line in lines:
+            graphWidget.removeItem(line)
+        first = self.channelPage * self.ChannelsPerPage
+        last = min(first + self.ChannelsPerPage, len(self.channelNames))
+        return [graphWidget.plot([],
+                                 name=self.channelNames[i],
+                                 pen=pyqtgraph.mkPen(
+                                     color=self.__channelColor(i)))
+                for i in range(first, last)]
+
+    def __channelColor(self, index):
+        if len(self.channelNames) <= len(self.ChannelColors):
+            return self.ChannelColors[index]
+        return pyqtgraph.intColor(index, hues=len(self.channelNames))
+
+    def __channelPageCallback(self, page):
+        self.channelPage = page - 1
+        self.setChannels(self.channelNames)
+        self.__showChannels(self.lastData)
+        if self.correctedGraphWidget:
+            self.__showChannels(self.lastCorrectedData, corrected=True)
+
+    def enableCorrectedPlot(self, mode):
+        if not self.correctedGraphWidget:
+            self.correctedGraphWidget = pyqtgraph.PlotWidget()
+            self.correctedGraphWidget.setTitle(
+                f"Drift Compensated ({mode})")
+            self.correctedGraphWidget.showGrid(x=True, y=True, alpha=0.3)
+            self.correctedGraphWidget.addLegend(
+                labelTextColor=(255, 255, 255),
+                pen=pyqtgraph.mkPen(width=2))
+            self.correctedGraphWidget.setDownsampling(auto=True, mode="peak")
+            self.correctedGraphWidget.setClipToView(True)
+            self.correctedLines = self.__plotChannels(
+                self.correctedGraphWidget, list())
+            self.serialLayout.addWidget(self.correctedGraphWidget)
+
+    def enableRecognition(self):
+        if not self.predictionLabel:
+            self.predictionLabel = QtWidgets.QLabel("Prediction: -")
+            self.earlyStopCheckBox = QtWidgets.QCheckBox(
+                "End Adsorption When Confident")
+            self.statusBar().addWidget(self.predictionLabel)
+            self.statusBar().addPermanentWidget(self.earlyStopCheckBox)
+
+    def isEarlyStopEnabled(self):
+        return bool(self.earlyStopCheckBox) and \
+            self.earlyStopCheckBox.isChecked()
+
+    def showPrediction(self, label, confidence):
+        self.predictionLabel.setText(
+            f"Prediction: {label} ({confidence:.0%})")
 
     def showImage(self, img):
-        self.imageItem.setImage(img)
+        # Frames arriving before the previous one was painted are dropped
+        if not self.imageItem.isPainted:
+            return
+        self.imageItem.setImage(self.__previewFrame(img),
+                                autoLevels=False, levels=(0, 255))
+
+    def __previewFrame(self, img):
+        # The image item only ever sees previewBuffer, the emitted frame
+        # goes back to the device's buffer pool once the next one arrives
+        scale = 1
+        if self.isPreviewScaled:
+            ratio = self.imageWidget.devicePixelRatioF()
+            scale = min(self.imageWidget.width() * ratio / img.shape[1],
+                        self.imageWidget.height() * ratio / img.shape[0])
+        if scale >= 1:
+            shape = img.shape
+        else:
+            shape = (max(1, int(img.shape[0] * scale)),
+                     max(1, int(img.shape[1] * scale))) + img.shape[2:]
+        if self.previewBuffer is None or self.previewBuffer.shape != shape:
+            self.previewBuffer = np.empty(shape, dtype=np.uint8)
+        if scale >= 1:
+            np.copyto(self.previewBuffer, img, casting="unsafe")
+        else:
+            cv2.resize(img, (shape[1], shape[0]), dst=self.previewBuffer,
+                       interpolation=cv2.INTER_AREA)
+        return self.previewBuffer
 
     def setPorts(self, ports):
         self.serialComboBox.clear()
@@ -108,54 +249,69 @@ class MainWindow(QtWidgets.QMainWindow):
         self.timerLCD.display(value)
 
     def logConnectedSerialDevice(self):
-        self.logPlainTextEdit.insertPlainText(
-            "(Event) Serial Device Connected\n")
-        self.logPlainTextEdit.moveCursor(QtGui.QTextCursor.End)
+        self.__log("Serial Device Connected")
 
     def logDisconnectedSerialDevice(self):
-        self.logPlainTextEdit.insertPlainText(
-            "(Event) Serial Device Disconnected\n")
-        self.logPlainTextEdit.moveCursor(QtGui.QTextCursor.End)
+        self.__log("Serial Device Disconnected")
 
     def logConnectedMicroscope(self):
-        self.logPlainTextEdit.insertPlainText(
-            "(Event) Microscope Connected\n")
-        self.logPlainTextEdit.moveCursor(QtGui.QTextCursor.End)
+        self.__log("Microscope Connected")
 
     def logDisconnectedMicroscope(self):
-        self.logPlainTextEdit.insertPlainText(
-            "(Event) Microscope Disconnected\n")
-        self.logPlainTextEdit.moveCursor(QtGui.QTextCursor.End)
+        self.__log("Microscope Disconnected")
 
     def logImageCaptured(self, timeCount):
-        self.logPlainTextEdit.insertPlainText(
-            f"(Event) Image Captured at ({timeCount}) seconds\n")
-        self.logPlainTextEdit.moveCursor(QtGui.QTextCursor.End)
+        self.__log(f"Image Captured at ({timeCount}) seconds")
 
     def logBaselineStartPoint(self):
-        self.logPlainTextEdit.insertPlainText(
-            "(Event) Baseline Started\n")
-        self.logPlainTextEdit.moveCursor(QtGui.QTextCursor.End)
+        self.__log("Baseline Started")
 
     def logAdsorptionStartPoint(self):
-        self.logPlainTextEdit.insertPlainText(
-            "(Event) Adsorption Started\n")
-        self.logPlainTextEdit.moveCursor(QtGui.QTextCursor.End)
+        self.__log("Adsorption Started")
 
     def logDesorptionStartPoint(self):
-        self.logPlainTextEdit.insertPlainText(
-            "(Event) Desorption Started\n")
-        self.logPlainTextEdit.moveCursor(QtGui.QTextCursor.End)
+        self.__log("Desorption Started")
+
+    def logEarlyAdsorptionEnd(self, label):
+        self.__log(f"Adsorption Ended Early ({label})")
+
+    def logError(self, message):
+        self.__log(message, "Error")
 
     def logCompleteSampling(self):
-        self.logPlainTextEdit.insertPlainText(
-            "(Event) Sampling Complete\n")
-        self.logPlainTextEdit.moveCursor(QtGui.QTextCursor.End)
+        self.__log("Sampling Complete")
+
+    def __log(self, text, level="Event"):
+        self.pendingLogLines.append(f"({level}) {text}")
+        self.event_logged.emit(level, text)
+
+    def __flushLog(self):
+        if self.pendingLogLines:
+            self.logPlainTextEdit.appendPlainText(
+                "\n".join(self.pendingLogLines))
+            self.pendingLogLines = list()
+            self.logPlainTextEdit.moveCursor(QtGui.QTextCursor.End)
 
     def __setupUI(self):
         self.setWindowTitle("Hybrid Electronic Nose")
         self.setWindowIcon(QtGui.QIcon(r"icons\\sigma.svg"))
+        self.channelPageSpinBox = QtWidgets.QSpinBox()
+        self.channelPageSpinBox.setRange(1, 1)
+        self.channelPageSpinBox.valueChanged.connect(
+            self.__channelPageCallback)
+        self.channelPageWidget = QtWidgets.QWidget()
+        channelPageLayout = QtWidgets.QHBoxLayout(self.channelPageWidget)
+        channelPageLayout.setContentsMargins(0, 0, 0, 0)
+        channelPageLayout.addWidget(QtWidgets.QLabel("Channel Group"))
+        channelPageLayout.addWidget(self.channelPageSpinBox)
+        channelPageLayout.addStretch()
+        self.channelPageWidget.setVisible(False)
+        self.serialLayout.addWidget(self.channelPageWidget)
+        self.graphWidget.setDownsampling(auto=True, mode="peak")
+        self.graphWidget.setClipToView(True)
         self.serialLayout.addWidget(self.graphWidget)
+        self.logPlainTextEdit.setMaximumBlockCount(self.MaximumLogLines)
+        self.logTimer.start(self.LogInterval)
         self.microscopeLayout.addWidget(self.imageWidget)
         self.upButton.setIcon(QtGui.QIcon(r"icons\\up.svg"))
         self.leftButton.setIcon(QtGui.QIcon(r"icons\\left.svg"))
@@ -190,13 +346,7 @@ class MainWindow(QtWidgets.QMainWindow):
         self.graphWidget.setYRange(0, 5)
         self.graphWidget.addLegend(labelTextColor=(255, 255, 255),
                                    pen=pyqtgraph.mkPen(width=2))
-        self.lines = [self.graphWidget.plot([],
-                                            name=channelName,
-                                            pen=pyqtgraph.mkPen(
-                                                color=channelColor))
-                      for channelName, channelColor in zip(
-                          self.ChannelNames,
-                          self.ChannelColors)]
+        self.lines = self.__plotChannels(self.graphWidget, list())
 
     def __graphSettingsResetCallback(self):
         self.graphWidget.clear()
@@ -211,81 +361,55 @@ class MainWindow(QtWidgets.QMainWindow):
         self.serial_closed.emit()
 
     def __serialRunCallback(self):
-        self.logPlainTextEdit.insertPlainText(
-            "(Event) Data Transfer Started\n")
-        self.logPlainTextEdit.moveCursor(QtGui.QTextCursor.End)
+        self.__log("Data Transfer Started")
         self.serial_started.emit(self.serialSamplingIntervalSpinBox.value())
 
     def __serialStopCallback(self):
-        self.logPlainTextEdit.insertPlainText(
-            "(Event) Data Transfer Stopped\n")
-        self.logPlainTextEdit.moveCursor(QtGui.QTextCursor.End)
+        self.__log("Data Transfer Stopped")
         self.serial_stopped.emit()
 
     def __refreshCallback(self):
-        self.logPlainTextEdit.insertPlainText(
-            "(Event) Search Available Ports\n")
-        self.logPlainTextEdit.moveCursor(QtGui.QTextCursor.End)
+        self.__log("Search Available Ports")
         self.serial_requested.emit()
 
     def __deliveryBeginCallback(self):
-        self.logPlainTextEdit.insertPlainText(
-            "(Event) Delivery Begun\n")
-        self.logPlainTextEdit.moveCursor(QtGui.QTextCursor.End)
+        self.__log("Delivery Begun")
         self.delivery_started.emit()
 
     def __deliveryStopCallback(self):
-        self.logPlainTextEdit.insertPlainText(
-            "(Event) Delivery Stop\n")
-        self.logPlainTextEdit.moveCursor(QtGui.QTextCursor.End)
+        self.__log("Delivery Stop")
         self.delivery_stopped.emit()
 
     def __videoConnectCallback(self):
-        self.logPlainTextEdit.insertPlainText(
-            "(Event) Connect Microscope\n")
-        self.logPlainTextEdit.moveCursor(QtGui.QTextCursor.End)
+        self.__log("Connect Microscope")
         self.video_opened.emit(int(self.videoComboBox.currentText()))
 
     def __videoDisconnectCallback(self):
-        self.logPlainTextEdit.insertPlainText(
-            "(Event) Disconnect Microscope\n")
-        self.logPlainTextEdit.moveCursor(QtGui.QTextCursor.End)
+        self.__log("Disconnect Microscope")
         self.video_closed.emit()
 
     def __videoRunCallback(self):
-        self.logPlainTextEdit.insertPlainText(
-            "(Event) Video Capture Started\n")
-        self.logPlainTextEdit.moveCursor(QtGui.QTextCursor.End)
+        self.__log("Video Capture Started")
         self.video_started.emit()
 
     def __videoStopCallback(self):
-        self.logPlainTextEdit.insertPlainText(
-            "(Event) Video Capture Stopped\n")
-        self.logPlainTextEdit.moveCursor(QtGui.QTextCursor.End)
+        self.__log("Video Capture Stopped")
         self.video_stopped.emit()
 
     def __upCallback(self):
-        self.logPlainTextEdit.insertPlainText(
-            "(Event) Move Rectangle Up\n")
-        self.logPlainTextEdit.moveCursor(QtGui.QTextCursor.End)
+        self.__log("Move Rectangle Up")
         self.upped.emit()
 
     def __downCallback(self):
-        self.logPlainTextEdit.insertPlainText(
-            "(Event) Move Rectangle Down\n")
-        self.logPlainTextEdit.moveCursor(QtGui.QTextCursor.End)
+        self.__log("Move Rectangle Down")
         self.downed.emit()
 
     def __leftCallback(self):
-        self.logPlainTextEdit.insertPlainText(
-            "(Event) Move Rectangle Left\n")
-        self.logPlainTextEdit.moveCursor(QtGui.QTextCursor.End)
+        self.__log("Move Rectangle Left")
         self.lefted.emit()
 
     def __rightCallback(self):
-        self.logPlainTextEdit.insertPlainText(
-            "(Event) Move Rectangle Right\n")
-        self.logPlainTextEdit.moveCursor(QtGui.QTextCursor.End)
+        self.__log("Move Rectangle Right")
         self.righted.emit()
 
     def __widthPlusCallback(self):
@@ -302,9 +426,7 @@ class MainWindow(QtWidgets.QMainWindow):
 
     def __sampleStartCallback(self):
         if self.sampleNameLineEdit.text():
-            self.logPlainTextEdit.insertPlainText(
-                "(Event) Sampling Started\n")
-            self.logPlainTextEdit.moveCursor(QtGui.QTextCursor.End)
+            self.__log("Sampling Started")
             self.sampling_started.emit({
                 "sample_name": self.sampleNameLineEdit.text(),
                 "sample_duration": self.sampleDurationSpinBox.value(),
@@ -313,14 +435,10 @@ class MainWindow(QtWidgets.QMainWindow):
                 "video_interval": self.videoSamplingIntevalSpinBox.value()
             })
         else:
-            self.logPlainTextEdit.insertPlainText(
-                "(Warning) Please Add Sample Name!\n")
-            self.logPlainTextEdit.moveCursor(QtGui.QTextCursor.End)
+            self.__log("Please Add Sample Name!", "Warning")
 
     def __sampleStopCallback(self):
-        self.logPlainTextEdit.insertPlainText(
-            "(Event) Sampling Stopped\n")
-        self.logPlainTextEdit.moveCursor(QtGui.QTextCursor.End)
+        self.__log("Sampling Stopped")
         self.sampling_stopped.emit()
 
 